@@ -4,23 +4,59 @@ Production-ready SpeechKit API для асинхронного распозна
 Цель: Обработка длинных аудиофайлов (>30 секунд, до 4 часов) для бизнеса
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 import httpx
+import orjson
+import asyncio
 import os
+import re
+import uuid
 import logging
+import itertools
+import time
+from collections import Counter, deque
 from datetime import datetime
-from typing import Optional
+from typing import AsyncIterator, Literal, Optional, Tuple
 import boto3
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
-from io import BytesIO
-from pydub import AudioSegment
+from contextlib import aclosing, asynccontextmanager
+from dataclasses import dataclass
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="SpeechKit Async STT API", version="2.0")
+# === LIFECYCLE ===
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Общий HTTP/2 клиент с пулом соединений к Yandex API и фоновая выгрузка метрик"""
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=1000),
+        timeout=httpx.Timeout(60.0, connect=5.0)
+    )
+    app.state.metrics_queue = asyncio.Queue(maxsize=METRICS_QUEUE_MAXSIZE)
+    app.state.metrics_flush_event = asyncio.Event()
+    app.state.metrics_drain = asyncio.create_task(drain_metrics())
+    app.state.metrics_drain.add_done_callback(on_metrics_drain_done)
+    try:
+        yield
+    finally:
+        app.state.metrics_drain.cancel()
+        await asyncio.gather(app.state.metrics_drain, return_exceptions=True)
+        flush_metrics()
+        await app.state.http.aclose()
+
+app = FastAPI(
+    title="SpeechKit Async STT API",
+    version="2.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
 
 # Конфигурация из переменных окружения
 YANDEX_API_KEY = os.getenv("YANDEX_API_KEY")
@@ -30,6 +66,10 @@ S3_ENDPOINT = os.getenv("S3_ENDPOINT", "https://storage.yandexcloud.net")
 AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 
+# Заголовки Yandex API не меняются за время жизни процесса — собираем один раз
+YANDEX_HEADERS = {"Authorization": f"Api-Key {YANDEX_API_KEY}"}
+YANDEX_HEADERS_JSON = {**YANDEX_HEADERS, "Content-Type": "application/json"}
+
 # Инициализация S3 клиента
 s3_client = boto3.client(
     's3',
@@ -39,6 +79,41 @@ s3_client = boto3.client(
     region_name='ru-central1'
 )
 
+# Отдельный S3 клиент для health check: короткие таймауты и без повторов,
+# чтобы недоступный S3 не подвешивал /api/v1/health дольше HEALTH_CHECK_TIMEOUT
+HEALTH_CHECK_TIMEOUT = 2.0  # секунды
+s3_health_client = boto3.client(
+    's3',
+    endpoint_url=S3_ENDPOINT,
+    aws_access_key_id=AWS_ACCESS_KEY,
+    aws_secret_access_key=AWS_SECRET_KEY,
+    region_name='ru-central1',
+    config=BotoConfig(connect_timeout=1, read_timeout=1, retries={'max_attempts': 1})
+)
+
+# Сигнатуры (magic bytes) поддерживаемых аудиоформатов.
+# MP3 без ID3v2-тега (ID3v1 в конце файла) начинается сразу с заголовка кадра Layer III:
+# 0xFFFB / 0xFFFA — MPEG-1 (без CRC / с CRC), 0xFFF3 / 0xFFF2 — MPEG-2 (без CRC / с CRC).
+# MPEG-2.5 (0xFFE3 / 0xFFE2) не распознаём: такие файлы определяются по MIME типу.
+AUDIO_SIGNATURES = {
+    b'ID3': "MP3",
+    b'\xff\xfb': "MP3",
+    b'\xff\xfa': "MP3",
+    b'\xff\xf3': "MP3",
+    b'\xff\xf2': "MP3",
+    b'OggS': "OGG_OPUS"
+}
+
+# Допустимые user_id и имена файлов в ключах S3: без "/" и "..", ключ всегда audio/{user_id}/{имя}
+USER_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,128}")
+S3_AUDIO_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]+\.ogg")
+
+# Время жизни presigned URL для прямой загрузки в S3 (секунды)
+S3_PRESIGN_EXPIRES = 3600
+
+# Размер части при потоковой загрузке (S3 требует минимум 5 MB на часть, кроме последней)
+S3_PART_SIZE = 8 * 1024 * 1024
+
 # Модели данных
 class TranscriptionRequest(BaseModel):
     audio_url: str
@@ -48,10 +123,22 @@ class TranscriptionRequest(BaseModel):
     audio_encoding: str = "OGG_OPUS"
     sample_rate_hertz: int = 48000
 
+class S3TranscriptionRequest(BaseModel):
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
+    s3_key: str
+    user_id: str
+    lang: str = "ru-RU"
+    # Presign выдаёт только .ogg ключи с ContentType audio/ogg, а start_recognition
+    # передаёт спецификацию Opus 48 kHz моно — другие кодировки здесь не поддерживаются
+    audio_encoding: Literal["OGG_OPUS"] = "OGG_OPUS"
+
 class OperationStatusRequest(BaseModel):
     operation_id: str
 
-class MetricsLog(BaseModel):
+@dataclass(slots=True)
+class MetricsLog:
+    """Внутренняя запись метрики: создаётся только сервером, валидация не нужна"""
     timestamp: str
     operation: str
     user_id: str
@@ -61,39 +148,338 @@ class MetricsLog(BaseModel):
     error: Optional[str] = None
     operation_id: Optional[str] = None
 
-# Хранилище метрик
-metrics_storage = []
+    def to_dict(self) -> dict:
+        # Поля берутся из __slots__, список не дублируется; в отличие от dataclasses.asdict — без deepcopy
+        return {field: getattr(self, field) for field in self.__slots__}
+
+# Хранилище метрик: последние METRICS_MAXLEN записей + накопительные счётчики
+METRICS_MAXLEN = 10_000
+metrics_storage = deque(maxlen=METRICS_MAXLEN)
+metrics_counters = {
+    "total_requests": 0,
+    "stt_start_requests": 0,
+    "stt_complete_requests": 0,
+    "errors": 0,
+    "dropped": 0,
+    "total_duration_ms": 0.0
+}
+
+# Очередь метрик: запросы только кладут запись, фоновая задача выгружает пачками
+METRICS_QUEUE_MAXSIZE = 10_000
+METRICS_FLUSH_INTERVAL = 0.1  # секунды
+METRICS_FLUSH_BATCH = 1000
+# Сама очередь и событие создаются в lifespan (app.state.metrics_queue,
+# app.state.metrics_flush_event): примитивы asyncio привязываются к event loop, в котором
+# впервые используются, и при повторном запуске приложения в том же процессе сломались бы
 
 # === CORE FUNCTIONS ===
 
-async def log_metrics(metric: MetricsLog):
-    """Асинхронное логирование метрик"""
-    metrics_storage.append(metric.dict())
-    logger.info(f"Metric logged: {metric.operation} - {metric.status}")
-
-async def upload_to_s3(file_data: bytes, filename: str) -> str:
-    """Загрузка файла в Object Storage"""
+def log_metrics(metric: MetricsLog):
+    """Постановка метрики в очередь; при переполнении метрика отбрасывается, запрос не ждёт"""
+    queue = app.state.metrics_queue
     try:
-        s3_client.put_object(
+        queue.put_nowait(metric.to_dict())
+    except asyncio.QueueFull:
+        metrics_counters["dropped"] += 1
+        return
+    if queue.qsize() >= METRICS_FLUSH_BATCH:
+        app.state.metrics_flush_event.set()
+
+def flush_metrics():
+    """Перенос накопленных метрик из очереди в хранилище, одна строка лога на пачку"""
+    queue = app.state.metrics_queue
+    while not queue.empty():
+        batch = []
+        while len(batch) < METRICS_FLUSH_BATCH and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        metrics_storage.extend(batch)
+        operations = Counter()
+        errors = 0
+        for m in batch:
+            operations[m['operation']] += 1
+            metrics_counters["total_duration_ms"] += m['duration_ms']
+            if m['status'] == 'error':
+                errors += 1
+        metrics_counters["total_requests"] += len(batch)
+        metrics_counters["stt_start_requests"] += operations["STT_ASYNC_START"]
+        metrics_counters["stt_complete_requests"] += operations["STT_ASYNC_COMPLETE"]
+        metrics_counters["errors"] += errors
+
+        summary = ", ".join(f"{op}={count}" for op, count in operations.items())
+        logger.info(f"Metrics logged: {len(batch)} ({summary}), errors: {errors}")
+
+async def drain_metrics():
+    """Фоновая выгрузка метрик: раз в METRICS_FLUSH_INTERVAL или при METRICS_FLUSH_BATCH записях"""
+    flush_event = app.state.metrics_flush_event
+    while True:
+        # Ни ошибка ожидания, ни ошибка одной пачки не должны останавливать выгрузку:
+        # иначе очередь переполнится и все следующие метрики уйдут в dropped
+        try:
+            try:
+                await asyncio.wait_for(flush_event.wait(), METRICS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            flush_event.clear()
+            flush_metrics()
+        except Exception:
+            logger.exception("Metrics flush failed")
+            # Пауза, чтобы постоянная ошибка не превратилась в busy loop
+            await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+
+def on_metrics_drain_done(task: asyncio.Task):
+    """Фоновая выгрузка метрик не должна завершаться молча"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Metrics drain task stopped", exc_info=task.exception())
+
+def validate_user_id(user_id: str):
+    """Проверка user_id перед подстановкой в ключ S3"""
+    if not USER_ID_PATTERN.fullmatch(user_id):
+        raise HTTPException(status_code=400, detail="Invalid user_id")
+
+async def upload_stream_to_s3(chunks: AsyncIterator[bytes], filename: str) -> Tuple[str, int]:
+    """Потоковая multipart загрузка в Object Storage без буферизации всего файла"""
+    try:
+        upload = await asyncio.to_thread(
+            s3_client.create_multipart_upload,
             Bucket=S3_BUCKET,
             Key=filename,
-            Body=file_data,
             ContentType='audio/ogg' if filename.endswith('.ogg') else 'audio/mpeg'
         )
-        logger.info(f"Uploaded to S3: {filename}")
-        return f"{S3_ENDPOINT}/{S3_BUCKET}/{filename}"
     except ClientError as e:
         logger.error(f"S3 upload error: {e}")
         raise HTTPException(status_code=500, detail="Storage error")
 
+    upload_id = upload["UploadId"]
+    parts = []
+    total_bytes = 0
+    pending = None
+
+    async def upload_part(part_number: int, body: bytes) -> dict:
+        response = await asyncio.to_thread(
+            s3_client.upload_part,
+            Bucket=S3_BUCKET,
+            Key=filename,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    try:
+        # Пока часть N загружается в S3, читаем (и конвертируем) часть N+1.
+        # В памяти одновременно не больше двух частей.
+        async with aclosing(chunks):
+            part_number = 0
+            async for chunk in chunks:
+                part_number += 1
+                if pending is not None:
+                    parts.append(await pending)
+                pending = asyncio.create_task(upload_part(part_number, chunk))
+                total_bytes += len(chunk)
+        if pending is not None:
+            parts.append(await pending)
+            pending = None
+
+        await asyncio.to_thread(
+            s3_client.complete_multipart_upload,
+            Bucket=S3_BUCKET,
+            Key=filename,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts}
+        )
+    except Exception as e:
+        # Дожидаемся загружаемой части, иначе abort может не удалить её
+        if pending is not None:
+            await asyncio.gather(pending, return_exceptions=True)
+        # Не оставляем в бакете недозагруженные части
+        try:
+            await asyncio.to_thread(
+                s3_client.abort_multipart_upload,
+                Bucket=S3_BUCKET,
+                Key=filename,
+                UploadId=upload_id
+            )
+        except ClientError as abort_error:
+            logger.warning(f"S3 multipart abort error: {abort_error}")
+        if isinstance(e, ClientError):
+            logger.error(f"S3 upload error: {e}")
+            raise HTTPException(status_code=500, detail="Storage error")
+        raise
+
+    logger.info(f"Uploaded to S3: {filename} ({len(parts)} parts)")
+    return f"{S3_ENDPOINT}/{S3_BUCKET}/{filename}", total_bytes
+
+async def read_upload_chunks(audio_file: UploadFile, first_chunk: bytes) -> AsyncIterator[bytes]:
+    """Чтение UploadFile частями по S3_PART_SIZE, начиная с уже прочитанной первой части"""
+    chunk = first_chunk
+    while chunk:
+        yield chunk
+        chunk = await audio_file.read(S3_PART_SIZE)
+
+async def convert_to_ogg_stream(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Конвертация MP3 → OGG (Opus, моно) одним процессом ffmpeg через pipe.
+
+    Вход подаётся в stdin по мере чтения, выход отдаётся частями по S3_PART_SIZE —
+    ни исходный файл, ни декодированный PCM целиком в памяти не держатся.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-v', 'quiet', '-i', 'pipe:0',
+        '-ac', '1', '-f', 'ogg', '-c:a', 'libopus', 'pipe:1',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE
+    )
+
+    async def feed_stdin():
+        try:
+            async for chunk in chunks:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        finally:
+            proc.stdin.close()
+
+    feeder = asyncio.create_task(feed_stdin())
+    buf = bytearray()
+    # aclosing закрывает входной генератор после того, как feeder гарантированно завершён
+    async with aclosing(chunks):
+        try:
+            while data := await proc.stdout.read(64 * 1024):
+                buf.extend(data)
+                if len(buf) >= S3_PART_SIZE:
+                    part = bytes(buf[:S3_PART_SIZE])
+                    # Удаляем отданную часть на месте, без копирования остатка в новый bytearray
+                    del buf[:S3_PART_SIZE]
+                    yield part
+
+            try:
+                await feeder
+            except (BrokenPipeError, ConnectionResetError) as e:
+                logger.error(f"Ошибка при конвертации MP3 → OGG: ffmpeg перестал читать вход ({e!r})")
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Audio conversion failed: ffmpeg stopped reading input ({type(e).__name__})"
+                )
+            if await proc.wait() != 0:
+                logger.error(f"Ошибка при конвертации MP3 → OGG: ffmpeg exit code {proc.returncode}")
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Audio conversion failed: ffmpeg exit code {proc.returncode}"
+                )
+            if buf:
+                yield bytes(buf)
+        finally:
+            # Процесс должен быть завершён и собран при любом исходе
+            feeder.cancel()
+            # Забираем результат feeder (в т.ч. BrokenPipeError), иначе asyncio
+            # залогирует "Task exception was never retrieved"
+            await asyncio.gather(feeder, return_exceptions=True)
+            if proc.returncode is None:
+                proc.kill()
+                # communicate() дочитывает stdout до EOF: wait() при непрочитанном
+                # stdout не завершается даже после kill
+                await proc.communicate()
+
+async def start_recognition(s3_uri: str, lang: str, audio_encoding: str) -> str:
+    """Запуск асинхронного распознавания в Yandex STT, возвращает operation_id"""
+    request_body = {
+        "config": {
+            "specification": {
+                "languageCode": lang,
+                "model": "general",
+                "audioEncoding": audio_encoding,
+                "sampleRateHertz": 48000,
+                "audioChannelCount": 1
+            }
+        },
+        "audio": {
+            "uri": s3_uri
+        }
+    }
+
+    logger.info(f"Sending request to Yandex STT API with S3 URI: {s3_uri}")
+
+    client = app.state.http
+    stt_response = await client.post(
+        "https://transcribe.api.cloud.yandex.net/speech/stt/v2/longRunningRecognize",
+        headers=YANDEX_HEADERS_JSON,
+        json=request_body,
+        timeout=30.0
+    )
+
+    logger.info(f"Yandex API response status: {stt_response.status_code}")
+    logger.debug(f"Yandex API response: {stt_response.text}")
+
+    if stt_response.status_code != 200:
+        logger.error(f"Yandex STT error: {stt_response.status_code} - {stt_response.text}")
+        raise HTTPException(
+            status_code=stt_response.status_code,
+            detail=f"Yandex STT error: {stt_response.text}"
+        )
+
+    operation_id = orjson.loads(stt_response.content).get("id")
+    logger.info(f"✓ STT operation started: {operation_id}")
+    return operation_id
+
+async def start_transcription(
+    s3_uri: str,
+    s3_path: str,
+    lang: str,
+    audio_encoding: str,
+    user_id: str,
+    file_size: float,
+    start_mono: float
+) -> dict:
+    """Запуск распознавания аудио из S3: метрика STT_ASYNC_START и ответ клиенту"""
+    operation_id = await start_recognition(s3_uri, lang, audio_encoding)
+    duration = (time.monotonic() - start_mono) * 1000
+
+    # Логирование метрик
+    metric = MetricsLog(
+        timestamp=datetime.now().isoformat(),
+        operation="STT_ASYNC_START",
+        user_id=user_id,
+        duration_ms=duration,
+        status="success",
+        file_size_kb=file_size,
+        operation_id=operation_id
+    )
+    log_metrics(metric)
+
+    return {
+        "success": True,
+        "operation_id": operation_id,
+        "s3_path": s3_path,
+        "file_size_kb": file_size,
+        "message": "Распознавание запущено. Используйте operation_id для проверки статуса.",
+        "check_status_url": f"/api/v1/stt/status/{operation_id}"
+    }
+
+def stt_start_failed(user_id: str, start_mono: float, error: Exception) -> HTTPException:
+    """Логирование неожиданной ошибки запуска распознавания, возвращает HTTPException для raise"""
+    duration = (time.monotonic() - start_mono) * 1000
+
+    logger.error(f"✗ STT error: {str(error)}", exc_info=error)
+
+    metric = MetricsLog(
+        timestamp=datetime.now().isoformat(),
+        operation="STT_ASYNC_START",
+        user_id=user_id,
+        duration_ms=duration,
+        status="error",
+        error=str(error)
+    )
+    log_metrics(metric)
+
+    return HTTPException(status_code=500, detail=str(error))
+
 # === API ENDPOINTS ===
 
 @app.post("/api/v1/stt/transcribe")
 async def transcribe_audio(
     audio_file: UploadFile = File(...),
     user_id: str = "default_user",
-    lang: str = "ru-RU",
-    background_tasks: BackgroundTasks = None
+    lang: str = "ru-RU"
 ):
     """
     Асинхронное распознавание речи для длинных аудио (>30 сек, до 4 часов)
@@ -104,21 +490,30 @@ async def transcribe_audio(
     3. Получение operation_id
     4. Возврат operation_id клиенту для проверки статуса
     """
-    start_time = datetime.now()
+    start_mono = time.monotonic()
+    start_ts = datetime.now()
+
+    # user_id попадает в ключ audio/{user_id}/... — те же правила, что и для presign
+    validate_user_id(user_id)
 
     try:
-        # Шаг 1: Читаем загруженный файл
-        audio_data = await audio_file.read()
-        file_size = len(audio_data) / 1024  # KB
+        # Шаг 1: Читаем только первую часть файла — её достаточно для определения формата
+        first_chunk = await audio_file.read(S3_PART_SIZE)
+        if not first_chunk:
+            raise HTTPException(status_code=400, detail="Empty audio file")
+
+        file_size = (audio_file.size or len(first_chunk)) / 1024  # KB
 
         logger.info(f"Received audio file: {audio_file.filename}, size: {file_size:.2f} KB")
-        
+
         # Определяем тип аудио по сигнатуре
-        if audio_data.startswith(b'ID3'):
-            audio_encoding = "MP3"
-        elif audio_data.startswith(b'OggS'):
-            audio_encoding = "OGG_OPUS"
-        else:
+        header = first_chunk[:4]
+        audio_encoding = (
+            AUDIO_SIGNATURES.get(header[:3])
+            or AUDIO_SIGNATURES.get(header)
+            or AUDIO_SIGNATURES.get(header[:2])
+        )
+        if audio_encoding is None:
             logger.warning("Не удалось определить формат по сигнатуре. Пробуем по MIME типу...")
             # fallback — определяем по MIME из UploadFile
             if "mp3" in audio_file.content_type:
@@ -130,124 +525,101 @@ async def transcribe_audio(
 
         logger.info(f"Detected audio format: {audio_encoding}")
 
-        # Если MP3 — конвертируем в OGG (Opus)
+        audio_chunks = read_upload_chunks(audio_file, first_chunk)
+
+        # Если MP3 — конвертируем в OGG (Opus) на лету
         if audio_encoding == "MP3":
-            try:
-                logger.info("Converting MP3 → OGG (Opus)...")
-                audio = AudioSegment.from_file(BytesIO(audio_data), format="mp3")
-                audio = audio.set_channels(1)
-                ogg_buffer = BytesIO()
-                audio.export(ogg_buffer, format="ogg", codec="libopus")
-                audio_data = ogg_buffer.getvalue()
-                audio_encoding = "OGG_OPUS"
-                logger.info(f"Conversion successful. New size: {len(audio_data) / 1024:.2f} KB")
-            except Exception as e:
-                logger.error(f"Ошибка при конвертации MP3 → OGG: {e}")
-                raise HTTPException(status_code=500, detail=f"Audio conversion failed: {e}")
+            logger.info("Converting MP3 → OGG (Opus)...")
+            audio_chunks = convert_to_ogg_stream(audio_chunks)
+            audio_encoding = "OGG_OPUS"
         else:
             logger.info("Audio is already in OGG format — conversion not required.")
 
-        # Шаг 2: Загружаем аудио в S3
-        s3_filename = f"audio/{user_id}/{datetime.now().strftime('%Y%m%d_%H%M%S')}.ogg"
-        s3_uri = await upload_to_s3(audio_data, s3_filename)
+        # Шаг 2: Потоково загружаем аудио в S3 частями по S3_PART_SIZE
+        s3_filename = f"audio/{user_id}/{start_ts.strftime('%Y%m%d_%H%M%S')}.ogg"
+        s3_uri, uploaded_bytes = await upload_stream_to_s3(audio_chunks, s3_filename)
 
-        logger.info(f"Audio uploaded to S3: {s3_uri}")
+        logger.info(f"Audio uploaded to S3: {s3_uri}, size: {uploaded_bytes / 1024:.2f} KB")
 
         # Шаг 3: Отправляем запрос на асинхронное распознавание
-        headers = {
-            "Authorization": f"Api-Key {YANDEX_API_KEY}",
-            "Content-Type": "application/json"
-        }
-
-        request_body = {
-            "config": {
-                "specification": {
-                    "languageCode": lang,
-                    "model": "general",
-                    "audioEncoding": audio_encoding,
-                    "sampleRateHertz": 48000,
-                    "audioChannelCount": 1
-                }
-            },
-            "audio": {
-                "uri": s3_uri
-            }
-        }
-
-        logger.info(f"Sending request to Yandex STT API with S3 URI: {s3_uri}")
-        
-        async with httpx.AsyncClient() as client:
-            stt_response = await client.post(
-                "https://transcribe.api.cloud.yandex.net/speech/stt/v2/longRunningRecognize",
-                headers=headers,
-                json=request_body,
-                timeout=30.0
-            )
-
-        duration = (datetime.now() - start_time).total_seconds() * 1000
-
-        logger.info(f"Yandex API response status: {stt_response.status_code}")
-        logger.debug(f"Yandex API response: {stt_response.text}")
-
-        if stt_response.status_code == 200:
-            result = stt_response.json()
-            operation_id = result.get("id")
-
-            logger.info(f"✓ STT operation started: {operation_id}")
-            
-            # Логирование метрик
-            metric = MetricsLog(
-                timestamp=datetime.now().isoformat(),
-                operation="STT_ASYNC_START",
-                user_id=user_id,
-                duration_ms=duration,
-                status="success",
-                file_size_kb=file_size,
-                operation_id=operation_id
-            )
-            if background_tasks:
-                background_tasks.add_task(log_metrics, metric)
-            else:
-                await log_metrics(metric)
-
-            return {
-                "success": True,
-                "operation_id": operation_id,
-                "s3_path": s3_filename,
-                "file_size_kb": file_size,
-                "message": "Распознавание запущено. Используйте operation_id для проверки статуса.",
-                "check_status_url": f"/api/v1/stt/status/{operation_id}"
-            }
-        else:
-            logger.error(f"Yandex STT error: {stt_response.status_code} - {stt_response.text}")
-            raise HTTPException(
-                status_code=stt_response.status_code,
-                detail=f"Yandex STT error: {stt_response.text}"
-            )
+        return await start_transcription(
+            s3_uri, s3_filename, lang, audio_encoding, user_id, file_size, start_mono
+        )
     except HTTPException:
         raise
     except Exception as e:
-        duration = (datetime.now() - start_time).total_seconds() * 1000
+        raise stt_start_failed(user_id, start_mono, e)
 
-        logger.error(f"✗ STT error: {str(e)}", exc_info=True)
+@app.post("/api/v1/stt/presign")
+async def presign_upload(user_id: str = "default_user"):
+    """
+    Presigned URL для загрузки аудио напрямую в S3, минуя API
 
-        metric = MetricsLog(
-            timestamp=datetime.now().isoformat(),
-            operation="STT_ASYNC_START",
-            user_id=user_id,
-            duration_ms=duration,
-            status="error",
-            error=str(e)
+    Клиент выполняет PUT по upload_url с заголовком Content-Type: audio/ogg,
+    затем вызывает POST /api/v1/stt/transcribe/s3 с полученным s3_key.
+    Рекомендуется для больших файлов: аудио не проходит через сервер.
+    """
+    validate_user_id(user_id)
+    # Ключ выдаётся до загрузки, поэтому суффикс uuid: два presign за одну секунду не перезапишут друг друга
+    s3_key = f"audio/{user_id}/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex}.ogg"
+    try:
+        # Подпись вычисляется локально, сетевого запроса нет
+        upload_url = s3_client.generate_presigned_url(
+            'put_object',
+            Params={'Bucket': S3_BUCKET, 'Key': s3_key, 'ContentType': 'audio/ogg'},
+            ExpiresIn=S3_PRESIGN_EXPIRES
         )
-        if background_tasks:
-            background_tasks.add_task(log_metrics, metric)
-        else:
-            await log_metrics(metric)
+    except ClientError as e:
+        logger.error(f"S3 presign error: {e}")
+        raise HTTPException(status_code=500, detail="Storage error")
 
-        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "upload_url": upload_url,
+        "s3_key": s3_key,
+        "expires_in": S3_PRESIGN_EXPIRES,
+        "transcribe_url": "/api/v1/stt/transcribe/s3"
+    }
+
+@app.post("/api/v1/stt/transcribe/s3")
+async def transcribe_from_s3(request: S3TranscriptionRequest):
+    """
+    Асинхронное распознавание аудио, уже загруженного в S3 по presigned URL
+
+    API не получает сами аудиоданные — в Yandex передаётся только S3 URI.
+    """
+    start_mono = time.monotonic()
+
+    validate_user_id(request.user_id)
+    key_prefix = f"audio/{request.user_id}/"
+    if (
+        not request.s3_key.startswith(key_prefix)
+        or not S3_AUDIO_NAME_PATTERN.fullmatch(request.s3_key[len(key_prefix):])
+    ):
+        raise HTTPException(status_code=400, detail="Invalid s3_key")
+
+    try:
+        try:
+            head = await asyncio.to_thread(s3_client.head_object, Bucket=S3_BUCKET, Key=request.s3_key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                raise HTTPException(status_code=404, detail="Audio file not found in storage")
+            logger.error(f"S3 head error: {e}")
+            raise HTTPException(status_code=500, detail="Storage error")
+
+        file_size = head["ContentLength"] / 1024  # KB
+        s3_uri = f"{S3_ENDPOINT}/{S3_BUCKET}/{request.s3_key}"
+
+        return await start_transcription(
+            s3_uri, request.s3_key, request.lang, request.audio_encoding,
+            request.user_id, file_size, start_mono
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise stt_start_failed(request.user_id, start_mono, e)
 
 @app.get("/api/v1/stt/status/{operation_id}")
-async def check_transcription_status(operation_id: str, background_tasks: BackgroundTasks = None):
+async def check_transcription_status(operation_id: str):
     """
     Проверка статуса асинхронного распознавания
 
@@ -256,23 +628,19 @@ async def check_transcription_status(operation_id: str, background_tasks: Backgr
     - response: результат распознавания (если done=true)
     - error: ошибка (если есть)
     """
-    start_time = datetime.now()
+    start_mono = time.monotonic()
 
     try:
-        headers = {
-            "Authorization": f"Api-Key {YANDEX_API_KEY}"
-        }
-
-        async with httpx.AsyncClient() as client:
-            status_response = await client.get(
-                f"https://operation.api.cloud.yandex.net/operations/{operation_id}",
-                headers=headers,
-                timeout=10.0
-            )
-        duration = (datetime.now() - start_time).total_seconds() * 1000
+        client = app.state.http
+        status_response = await client.get(
+            f"https://operation.api.cloud.yandex.net/operations/{operation_id}",
+            headers=YANDEX_HEADERS,
+            timeout=10.0
+        )
+        duration = (time.monotonic() - start_mono) * 1000
 
         if status_response.status_code == 200:
-            result = status_response.json()
+            result = orjson.loads(status_response.content)
             done = result.get("done", False)
 
             response_data = {
@@ -286,13 +654,11 @@ async def check_transcription_status(operation_id: str, background_tasks: Backgr
                 if "response" in result:
                     # Извлекаем распознанный текст
                     chunks = result["response"].get("chunks", [])
-                    texts = []
-                    for chunk in chunks:
-                        alternatives = chunk.get("alternatives", [])
-                        if alternatives:
-                            texts.append(alternatives[0].get("text", ""))
-
-                    full_text = " ".join(texts)
+                    full_text = " ".join(
+                        alternatives[0].get("text", "")
+                        for chunk in chunks
+                        if (alternatives := chunk.get("alternatives"))
+                    )
                     response_data["text"] = full_text
                     response_data["chunks_count"] = len(chunks)
 
@@ -307,8 +673,7 @@ async def check_transcription_status(operation_id: str, background_tasks: Backgr
                         status="success",
                         operation_id=operation_id
                     )
-                    if background_tasks:
-                        background_tasks.add_task(log_metrics, metric)
+                    log_metrics(metric)
 
                 elif "error" in result:
                     response_data["error"] = result["error"]
@@ -330,14 +695,19 @@ async def check_transcription_status(operation_id: str, background_tasks: Backgr
 @app.get("/api/v1/metrics")
 async def get_metrics(limit: int = 100):
     """Получение метрик для мониторинга"""
+    total = metrics_counters["total_requests"]
+    # Берём последние limit записей с конца deque, не проходя весь буфер
+    recent = list(itertools.islice(reversed(metrics_storage), max(0, limit)))
+    recent.reverse()
     return {
-        "total_requests": len(metrics_storage),
-        "recent_metrics": metrics_storage[-limit:],
+        "total_requests": total,
+        "recent_metrics": recent,
         "summary": {
-            "stt_start_requests": len([m for m in metrics_storage if m['operation'] == 'STT_ASYNC_START']),
-            "stt_complete_requests": len([m for m in metrics_storage if m['operation'] == 'STT_ASYNC_COMPLETE']),
-            "errors": len([m for m in metrics_storage if m['status'] == 'error']),
-            "avg_duration_ms": sum(m['duration_ms'] for m in metrics_storage) / len(metrics_storage) if metrics_storage else 0
+            "stt_start_requests": metrics_counters["stt_start_requests"],
+            "stt_complete_requests": metrics_counters["stt_complete_requests"],
+            "errors": metrics_counters["errors"],
+            "dropped_metrics": metrics_counters["dropped"],
+            "avg_duration_ms": metrics_counters["total_duration_ms"] / total if total else 0
         }
     }
 @app.post("/api/v1/metrics")
@@ -347,8 +717,7 @@ async def log_metrics_post(
     status: str,
     duration_ms: int = 0,
     file_size_kb: float = 0.0,
-    language: str = "ru-RU",
-    background_tasks: BackgroundTasks = None
+    language: str = "ru-RU"
 ):
     """
     POST endpoint для логирования метрик из n8n.
@@ -356,8 +725,9 @@ async def log_metrics_post(
     Пример curl:
     curl -X POST "http://45.144.179.8:8000/api/v1/metrics?workflow_name=n8n_stt&user_id=123&status=success&duration_ms=1500"
     """
+    now = datetime.now()
     metric = MetricsLog(
-        timestamp=datetime.now().isoformat(),
+        timestamp=now.isoformat(),
         operation=workflow_name,
         user_id=user_id,
         duration_ms=duration_ms,
@@ -366,51 +736,50 @@ async def log_metrics_post(
         error=None
     )
     
-    if background_tasks:
-        background_tasks.add_task(log_metrics, metric)
-    else:
-        await log_metrics(metric)
-    
-    logger.info(
-        f"Metric logged: {workflow_name} | user={user_id} | "
-        f"status={status} | duration={duration_ms}ms"
-    )
+    log_metrics(metric)
     
     return {
         "message": "Metric received and logged",
         "ok": True,
-        "metric_id": f"{user_id}_{datetime.now().timestamp()}"
+        "metric_id": f"{user_id}_{now.timestamp()}"
     }
 
 
 @app.get("/api/v1/health")
 async def health_check():
-    """Health check для мониторинга"""
-    try:
-        async with httpx.AsyncClient() as client:
-            # Обращаемся к правильному endpoint Yandex API
-            response = await client.post(
-                "https://transcribe.api.cloud.yandex.net/speech/stt/v2/longRunningRecognize",
-                headers={"Authorization": f"Api-Key {YANDEX_API_KEY}"},
-                json={"config": {}, "audio": {"uri": ""}},
-                timeout=5.0
-            )
+    """
+    Health check для мониторинга
 
-        return {
-            "status": "healthy",
-            "timestamp": datetime.now().isoformat(),
-            "yandex_stt_api": "available",
-            "s3": "connected"
-        }
-    except Exception as e:
-        logger.warning(f"Health check warning: {e}")
-        return {
-            "status": "healthy",
-            "timestamp": datetime.now().isoformat(),
-            "yandex_stt_api": "available",
-            "s3": "connected",
-            "warning": str(e)
-        }
+    Проверки лёгкие и выполняются параллельно: HEAD к хосту Yandex STT
+    (любой HTTP-ответ означает, что API доступен) и head_bucket в S3.
+    """
+    yandex_result, s3_result = await asyncio.gather(
+        app.state.http.head("https://transcribe.api.cloud.yandex.net/", timeout=HEALTH_CHECK_TIMEOUT),
+        asyncio.wait_for(
+            asyncio.to_thread(s3_health_client.head_bucket, Bucket=S3_BUCKET),
+            HEALTH_CHECK_TIMEOUT
+        ),
+        return_exceptions=True
+    )
+
+    response = {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "yandex_stt_api": "available",
+        "s3": "connected"
+    }
+    warnings = []
+    if isinstance(yandex_result, Exception):
+        response["yandex_stt_api"] = "unavailable"
+        warnings.append(f"Yandex STT API: {str(yandex_result) or type(yandex_result).__name__}")
+    if isinstance(s3_result, Exception):
+        response["s3"] = "unavailable"
+        warnings.append(f"S3: {str(s3_result) or type(s3_result).__name__}")
+
+    if warnings:
+        logger.warning(f"Health check warning: {'; '.join(warnings)}")
+        response["warning"] = "; ".join(warnings)
+    return response
 
 
 @app.get("/")
@@ -423,6 +792,8 @@ async def root():
         "description": "Асинхронное распознавание речи для длинных аудио (до 4 часов)",
         "endpoints": {
             "POST /api/v1/stt/transcribe": "Запустить распознавание (загрузка аудио)",
+            "POST /api/v1/stt/presign": "Presigned URL для прямой загрузки аудио в S3",
+            "POST /api/v1/stt/transcribe/s3": "Запустить распознавание аудио, загруженного в S3",
             "GET /api/v1/stt/status/{operation_id}": "Проверить статус распознавания",
             "GET /api/v1/metrics": "Метрики системы",
             "GET /api/v1/health": "Health check"